@@ -1,22 +1,324 @@
 # Import necessary libraries
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from langchain_openai import AzureChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.caches import BaseCache
 from dotenv import load_dotenv
 import os
 import datetime
 import uuid
+import threading
+import time
+from collections import OrderedDict, deque
+import orjson
+import tiktoken
+import redis
 
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Use orjson for request parsing and jsonify() responses
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson.
+    Honors sort_keys and the pretty-print indent Flask requests in debug mode.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+# Bounded LLM response cache that is safe to share across request threads
+class LRUResponseCache(BaseCache):
+    """
+    Thread-safe LLM response cache keyed on (prompt, llm_string).
+    Evicts the least recently used entry once maxsize entries are stored.
+    """
+
+    def __init__(self, maxsize):
+        self._cache = OrderedDict()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def lookup(self, prompt, llm_string):
+        key = (prompt, llm_string)
+        with self._lock:
+            return_val = self._cache.get(key)
+            if return_val is not None:
+                self._cache.move_to_end(key)
+            return return_val
+
+    def update(self, prompt, llm_string, return_val):
+        key = (prompt, llm_string)
+        with self._lock:
+            self._cache[key] = return_val
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._cache.clear()
+
+
 # Initialize Flask application
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Add this: Initialize chat history storage with session support
-chat_histories = {}
+# Ordered by last use so the least recently used session can be evicted
+chat_histories = OrderedDict()
 MAX_HISTORY_LENGTH = 10
+# Maximum number of sessions kept in memory before the least recently used is dropped
+MAX_SESSIONS = 10_000
+# Prebuilt (HumanMessage, AIMessage) pairs and their token counts per session, appended to on each turn
+context_cache = {}
+# Maximum number of prompt tokens spent on previous turns; older turns are dropped first
+CONTEXT_TOKEN_BUDGET = 1500
+# Number of prompt/response pairs kept in the in-process LLM response cache
+LLM_CACHE_SIZE = 1000
+# Guards chat_histories and context_cache when requests are served from multiple threads
+history_lock = threading.Lock()
+# When REDIS_URL is set, histories live in Redis and are shared by all worker processes
+REDIS_URL = os.getenv("REDIS_URL")
+HISTORY_KEY_PREFIX = "history:"
+# Marks a session as known from its first /ask until it expires, even while its history is empty
+SESSION_KEY_PREFIX = "session:"
+# Redis session and history keys expire after this long without an /ask
+HISTORY_TTL_SECONDS = 7 * 24 * 60 * 60
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+
+def init_session(session_id):
+    """
+    Create empty history and context storage for a session if it doesn't exist,
+    mark it as most recently used, and evict the oldest sessions past MAX_SESSIONS.
+    Returns the session's history list. Callers must hold history_lock.
+    """
+    session_history = chat_histories.get(session_id)
+    if session_history is not None:
+        chat_histories.move_to_end(session_id)
+        return session_history
+
+    # Bounded deques drop the oldest turn on append once MAX_HISTORY_LENGTH is reached
+    session_history = chat_histories[session_id] = deque(maxlen=MAX_HISTORY_LENGTH)
+    context_cache[session_id] = deque(maxlen=MAX_HISTORY_LENGTH)
+    while len(chat_histories) > MAX_SESSIONS:
+        evicted_id, _ = chat_histories.popitem(last=False)
+        context_cache.pop(evicted_id, None)
+    return session_history
+
+
+# gpt-4o tokenizer used to size turns against CONTEXT_TOKEN_BUDGET; None until loaded in the background
+encoding = None
+encoding_loading = False
+encoding_retry_at = 0.0
+# Seconds to wait before retrying a failed tokenizer load
+ENCODING_RETRY_SECONDS = 300
+# Guards the encoding_loading/encoding_retry_at state; never held during the download
+encoding_lock = threading.Lock()
+
+
+def load_encoding():
+    """
+    Load the tokenizer, scheduling a retry after ENCODING_RETRY_SECONDS if its BPE file can't be fetched
+    (e.g. offline without TIKTOKEN_CACHE_DIR).
+    """
+    global encoding, encoding_loading, encoding_retry_at
+
+    try:
+        loaded = tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        print(f"Falling back to approximate token counts: {type(e).__name__}: {str(e)}")
+        loaded = None
+
+    with encoding_lock:
+        if loaded is not None:
+            encoding = loaded
+        else:
+            encoding_retry_at = time.monotonic() + ENCODING_RETRY_SECONDS
+        encoding_loading = False
+
+
+def start_encoding_load():
+    """
+    Start loading the tokenizer in a background thread unless it is loaded, loading, or backing off.
+    """
+    global encoding_loading
+
+    with encoding_lock:
+        if encoding is not None or encoding_loading or time.monotonic() < encoding_retry_at:
+            return
+        encoding_loading = True
+    threading.Thread(target=load_encoding, daemon=True).start()
+
+
+def count_tokens(text):
+    """
+    Count the tokens in text, approximating 4 characters per token until the tokenizer is loaded.
+    """
+    current_encoding = encoding
+    if current_encoding is None:
+        start_encoding_load()
+        return (len(text) + 3) // 4
+    return len(current_encoding.encode_ordinary(text))
+
+
+# Fetch the tokenizer at startup without delaying it
+start_encoding_load()
+
+
+def build_context(session_id):
+    """
+    Return the messages of the most recent turns for a session that fit within CONTEXT_TOKEN_BUDGET.
+    """
+    if redis_client is not None:
+        # Register the session and refresh both keys' TTLs in the same round trip as the read
+        history_key = HISTORY_KEY_PREFIX + session_id
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(SESSION_KEY_PREFIX + session_id, 1, ex=HISTORY_TTL_SECONDS)
+            pipe.expire(history_key, HISTORY_TTL_SECONDS)
+            pipe.lrange(history_key, 0, -1)
+            stored_turns = [orjson.loads(item) for item in pipe.execute()[-1]]
+        session_turns = [
+            ((HumanMessage(turn["entry"]["question"]), AIMessage(turn["entry"]["answer"])), turn["tokens"])
+            for turn in stored_turns
+        ]
+    else:
+        with history_lock:
+            init_session(session_id)
+            session_turns = list(context_cache[session_id])
+
+    turns = []
+    remaining = CONTEXT_TOKEN_BUDGET
+    for messages, tokens in reversed(session_turns):
+        if tokens > remaining:
+            break
+        remaining -= tokens
+        turns.append(messages)
+    return [message for messages in reversed(turns) for message in messages]
+
+
+def record_turn(session_id, question, answer):
+    """
+    Append a completed question/answer turn to a session's history and context cache.
+    Returns the new history entry.
+    """
+    new_entry = {
+        "question": question,
+        "answer": answer,
+        "timestamp": str(datetime.datetime.now())
+    }
+    # Size the turn once so later requests can budget context without re-tokenizing
+    context_tokens = count_tokens(question) + count_tokens(answer)
+
+    if redis_client is not None:
+        # Append and trim atomically so concurrent workers never see an over-long history
+        history_key = HISTORY_KEY_PREFIX + session_id
+        with redis_client.pipeline() as pipe:
+            pipe.rpush(history_key, orjson.dumps({"entry": new_entry, "tokens": context_tokens}))
+            pipe.ltrim(history_key, -MAX_HISTORY_LENGTH, -1)
+            pipe.expire(history_key, HISTORY_TTL_SECONDS)
+            # The session may have been cleared while waiting on the model
+            pipe.set(SESSION_KEY_PREFIX + session_id, 1, ex=HISTORY_TTL_SECONDS)
+            pipe.execute()
+        return new_entry
+
+    # Build the turn's messages once so later requests can reuse them
+    context_messages = (HumanMessage(question), AIMessage(answer))
+
+    with history_lock:
+        # The session may have been cleared while waiting on the model
+        session_history = init_session(session_id)
+
+        # Update chat history for this session (the deque keeps only MAX_HISTORY_LENGTH entries)
+        session_history.append(new_entry)
+        context_cache[session_id].append((context_messages, context_tokens))
+
+    return new_entry
+
+
+def get_session_history(session_id):
+    """
+    Return a copy of the chat history for a session, or an empty list if it has none.
+    """
+    if redis_client is not None:
+        return [orjson.loads(item)["entry"] for item in redis_client.lrange(HISTORY_KEY_PREFIX + session_id, 0, -1)]
+
+    with history_lock:
+        return list(chat_histories.get(session_id, []))
+
+
+def clear_session(session_id):
+    """
+    Clear the chat history for a session.
+    Returns True if the session existed.
+    """
+    if redis_client is not None:
+        # Keep the session marker so the session stays listed, as in memory
+        with redis_client.pipeline() as pipe:
+            pipe.exists(SESSION_KEY_PREFIX + session_id)
+            pipe.delete(HISTORY_KEY_PREFIX + session_id)
+            session_exists, _ = pipe.execute()
+        return session_exists > 0
+
+    with history_lock:
+        if session_id not in chat_histories:
+            return False
+        chat_histories[session_id].clear()
+        context_cache[session_id].clear()
+        return True
+
+
+def clear_all_sessions():
+    """
+    Clear the chat histories for all sessions.
+    Returns the number of sessions cleared.
+    """
+    global chat_histories, context_cache
+
+    if redis_client is not None:
+        session_keys = list(redis_client.scan_iter(match=SESSION_KEY_PREFIX + "*"))
+        history_keys = list(redis_client.scan_iter(match=HISTORY_KEY_PREFIX + "*"))
+        if session_keys or history_keys:
+            redis_client.delete(*session_keys, *history_keys)
+        return len(session_keys)
+
+    with history_lock:
+        session_count = len(chat_histories)
+        chat_histories = OrderedDict()
+        context_cache = {}
+    return session_count
+
+
+def list_sessions():
+    """
+    Return the IDs of all known sessions, including ones whose history is empty.
+    """
+    if redis_client is not None:
+        return [key[len(SESSION_KEY_PREFIX):] for key in redis_client.scan_iter(match=SESSION_KEY_PREFIX + "*")]
+
+    with history_lock:
+        return list(chat_histories.keys())
+
+
+def sse_event(payload, event=None):
+    """
+    Format a JSON payload as a Server-Sent Events message.
+    """
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(payload).decode()}\n\n"
 
 # Section 1: Configure and Validate Azure OpenAI Environment Variables
 required_vars = {
@@ -35,13 +337,17 @@ try:
         openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
         azure_deployment=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT_NAME"),
         temperature=0.7,
-        max_tokens=500
+        max_tokens=500,
+        # Repeated prompts (same question with the same history) skip the round trip.
+        # chain.stream() bypasses LangChain's cache, so '?stream=true' always calls the model.
+        cache=LRUResponseCache(maxsize=LLM_CACHE_SIZE)
     )
 except Exception as e:
     raise RuntimeError(f"Failed to initialize AzureChatOpenAI: {str(e)}")
 
 prompt_template = ChatPromptTemplate.from_messages([
     ("system", "You are a helpful assistant providing concise and accurate answers. Maintain context from the conversation history."),
+    MessagesPlaceholder("history"),
     ("human", "{question}")
 ])
 
@@ -54,10 +360,10 @@ def ask_question():
     """
     REST API endpoint to ask a question to GPT-4o.
     Expects a JSON payload with 'question' field and optional 'session_id'.
-    Returns the model's response as JSON along with the chat history for that session.
+    Returns the model's response as JSON along with the new history entry.
+    The full session history is included only when '?include_history=true' is passed.
+    With '?stream=true' the answer is streamed as Server-Sent Events instead.
     """
-    global chat_histories
-
     try:
         # Get JSON data from the request
         data = request.get_json()
@@ -67,51 +373,51 @@ def ask_question():
         # Extract question and session_id from the request
         question = data['question']
         session_id = data.get('session_id', 'default_session')
+        include_history = request.args.get('include_history', 'false').lower() == 'true'
+        stream = request.args.get('stream', 'false').lower() == 'true'
         print(f"Question received from session {session_id}: {question}")
 
-        # Initialize session history if it doesn't exist
-        if session_id not in chat_histories:
-            chat_histories[session_id] = []
+        # Initialize session history if it doesn't exist and snapshot its context
+        history_messages = build_context(session_id)
 
-        # Get the chat history for this session
-        session_history = chat_histories[session_id]
+        chain_input = {
+            "question": question,
+            "history": history_messages
+        }
 
-        # Create context from chat history
-        context = ""
-        if session_history:
-            context = "Previous conversation:\n"
-            for entry in session_history:
-                context += f"Human: {entry['question']}\nAI: {entry['answer']}\n"
+        # Stream the answer as Server-Sent Events and record the turn once it completes
+        if stream:
+            def generate():
+                chunks = []
+                try:
+                    for chunk in chain.stream(chain_input):
+                        chunks.append(chunk.content)
+                        yield sse_event({"delta": chunk.content})
+                    answer = "".join(chunks)
+                    print(f"Response for session {session_id}: {answer}")
+                    new_entry = record_turn(session_id, question, answer)
+                    yield sse_event({"status": "success", "session_id": session_id, "turn": new_entry}, event="done")
+                except Exception as e:
+                    yield sse_event({"error": f"Unexpected error: {type(e).__name__}: {str(e)}"}, event="error")
 
-        # Prepare the question with context if there's history
-        contextualized_question = question
-        if context:
-            contextualized_question = f"{context}\nHuman: {question}"
+            return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
         # Invoke the chain with the user's question
-        response = chain.invoke({
-            "question": contextualized_question
-        })
+        response = chain.invoke(chain_input)
         print(f"Response for session {session_id}: {response.content}")
 
-        # Update chat history for this session
-        chat_histories[session_id].append({
-            "question": question,
-            "answer": response.content,
-            "timestamp": str(datetime.datetime.now())
-        })
+        new_entry = record_turn(session_id, question, response.content)
 
-        # Limit chat history to MAX_HISTORY_LENGTH entries
-        if len(chat_histories[session_id]) > MAX_HISTORY_LENGTH:
-            chat_histories[session_id] = chat_histories[session_id][-MAX_HISTORY_LENGTH:]
-
-        # Return the response with chat history for this session
-        return jsonify({
+        # Return the response with the new turn (and the full history only if requested)
+        result = {
             "answer": response.content,
             "status": "success",
             "session_id": session_id,
-            "history": chat_histories[session_id]
-        }), 200
+            "turn": new_entry
+        }
+        if include_history:
+            result["history"] = get_session_history(session_id)
+        return jsonify(result), 200
 
     except KeyError as e:
         return jsonify({"error": f"KeyError: {str(e)}"}), 500
@@ -127,17 +433,11 @@ def get_history():
     Returns the chat history for that session as JSON.
     """
     session_id = request.args.get('session_id', 'default_session')
-
-    if session_id not in chat_histories:
-        return jsonify({
-            "history": [],
-            "count": 0,
-            "session_id": session_id
-        }), 200
+    history = get_session_history(session_id)
 
     return jsonify({
-        "history": chat_histories[session_id],
-        "count": len(chat_histories[session_id]),
+        "history": history,
+        "count": len(history),
         "session_id": session_id
     }), 200
 
@@ -152,8 +452,7 @@ def clear_history():
     data = request.get_json() or {}
     session_id = data.get('session_id', 'default_session')
 
-    if session_id in chat_histories:
-        chat_histories[session_id] = []
+    if clear_session(session_id):
         message = f"Chat history for session {session_id} cleared successfully"
     else:
         message = f"No history found for session {session_id}"
@@ -170,9 +469,7 @@ def clear_all_history():
     REST API endpoint to clear all chat histories for all sessions.
     Returns a confirmation message.
     """
-    global chat_histories
-    session_count = len(chat_histories)
-    chat_histories = {}
+    session_count = clear_all_sessions()
     return jsonify({
         "message": f"Chat history cleared for all {session_count} sessions",
         "status": "success"
@@ -196,12 +493,13 @@ def get_sessions():
     REST API endpoint to retrieve all active session IDs.
     Returns a list of all session IDs as JSON.
     """
+    sessions = list_sessions()
     return jsonify({
-        "sessions": list(chat_histories.keys()),
-        "count": len(chat_histories)
+        "sessions": sessions,
+        "count": len(sessions)
     }), 200
 
 # Section 7: Run the Flask Application
 if __name__ == '__main__':
-    # Start the Flask server on port 3000
-    app.run(host='0.0.0.0', port=3000, debug=True)
\ No newline at end of file
+    # Start the threaded development server on port 3000 (set FLASK_DEBUG=1 for the debugger/reloader)
+    app.run(host='0.0.0.0', port=3000)
\ No newline at end of file